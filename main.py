@@ -2,7 +2,7 @@ import pgn_utils as pu
 
 import output  
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 import os, time
 
 # -- config lives ONLY here ---------------------------------------------------
@@ -23,27 +23,38 @@ MIN_WHITE_MOVES = 15
 def main(): 
     t0 = time.time()
 
+    workers = max(1, round((os.cpu_count() or 2) / 2) - 1)
+
     games = pu.parse_pgn(
         PGN_PATH, HEADERS_TO_KEEP,
-        MAX_GAMES, MIN_WHITE_MOVES
+        MAX_GAMES, MIN_WHITE_MOVES, workers
     )
 
-    workers = max(1, round((os.cpu_count() or 2) / 2) - 1)
-    chunks = pu.chunked(games, workers)
+    shm, payloads = pu.share_moves(games)
+    pu.log.debug("%d workers, depth %d, hash %d MB per engine",
+                 workers, DEPTH, pu.capped_hash_mb(HASH_MB, DEPTH))
 
+    # one task per game, handed out in small batches: long games no longer
+    # hold up a whole static chunk, and the parent wakes once per batch.
+    # ProcessPoolExecutor (not mp.Pool) so a worker that dies or fails to
+    # start its engine raises BrokenProcessPool instead of hanging the run.
+    chunksize = max(1, min(16, len(payloads) // (workers * 4)))
     all_results = []
-    with ProcessPoolExecutor(max_workers=workers) as pool:
-        future_map = {
-            pool.submit(
-                pu.analyse_chunk, chunk, wid+1,
-                STOCKFISH_PATH, DEPTH, HASH_MB, PROGRESS_EVERY
-            ): wid+1
-            for wid, chunk in enumerate(chunks)
-        }
-        for fut in as_completed(future_map):
-            wid = future_map[fut]
-            all_results.extend(fut.result())
-            print(f"✓ Chunk {wid}/{len(chunks)} done", flush=True)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=pu.init_worker,
+            initargs=(shm.name, STOCKFISH_PATH, DEPTH, HASH_MB)
+        ) as pool:
+            for done, result in enumerate(
+                pool.map(pu.analyse_game, payloads, chunksize=chunksize), 1
+            ):
+                all_results.append(result)
+                if done % PROGRESS_EVERY == 0 or done == len(payloads):
+                    print(f"{done}/{len(payloads)} games analysed", flush=True)
+    finally:
+        shm.close()
+        shm.unlink()
 
     all_results.sort(key=lambda x: x[0])
     output.write_results(CSV_PATH, HEADERS_TO_KEEP, all_results)
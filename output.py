@@ -1,25 +1,64 @@
 #!/usr/bin/env python3
 
-import csv, json
+import base64, csv, sys
+from array import array
 from pathlib import Path
 from typing import Sequence
 
 
-def write_results(csv_path, headers_to_keep, all_results):
+def pack_scores(scores):
+    """Centipawn list, or native int16 bytes as returned by the workers,
+    -> base64 of little-endian int16s (2 bytes per ply)."""
+    a = array("h", scores)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return base64.b64encode(a.tobytes()).decode("ascii")
 
 
-    csv_path.parent.mkdir(parents=True, exist_ok=True)
+def unpack_scores(cell):
+    """Inverse of pack_scores, for reading a Scores cell back."""
+    a = array("h", base64.b64decode(cell))
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tolist()
 
-    with csv_path.open("w", newline="", encoding="utf-8") as csvf:
 
-        w = csv.writer(csvf) 
-        w.writerow(["GameIndex", *headers_to_keep, "Scores"])
+def _rows(headers_to_keep, all_results):
+    yield ["GameIndex", *headers_to_keep, "Scores"]
+    for idx, headers, scores in all_results:
+        yield (
+            [idx]
+            + [headers.get(h, "") for h in headers_to_keep]
+            + [pack_scores(scores)]
+        )
 
-        for idx, headers, scores in all_results:
-            w.writerow(
-                [idx]
-                + [headers.get(h, "") for h in headers_to_keep]
-                + [json.dumps(scores)]
-            )
-  
-  
\ No newline at end of file
+
+def _write_csv(path, rows):
+    with path.open("w", newline="", encoding="utf-8") as csvf:
+        csv.writer(csvf).writerows(rows)
+
+
+def _write_xlsx(path, rows):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        sys.exit("Writing .xlsx results needs openpyxl: pip install openpyxl")
+
+    # write-only mode streams rows to disk instead of building the sheet in RAM
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("scores")
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+
+
+def write_results(out_path, headers_to_keep, all_results):
+    """Write one row per game; format follows the suffix (.csv or .xlsx)."""
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    rows = _rows(headers_to_keep, all_results)
+
+    if out_path.suffix.lower() == ".xlsx":
+        _write_xlsx(out_path, rows)
+    else:
+        _write_csv(out_path, rows)
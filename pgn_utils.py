@@ -1,46 +1,272 @@
-import sys, math
+import logging, mmap, os, re, sys, subprocess
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+from multiprocessing import shared_memory
+from multiprocessing.util import Finalize
 from pathlib import Path
 import chess
-import chess.pgn
-import chess.engine
+
+# run detail goes here, silent unless the caller configures logging; only
+# the parent process logs (spawned workers never see the caller's set-up)
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
 
 
 
 # 1) PGN parsing
 
-def parse_pgn(pgn_path, headers_to_keep, max_games=None, min_white_moves=0):
+_MIN_SHARD  = 4 << 20  # bytes; smaller files are parsed in-process
+# Runs up to the next line starting with "[", stepping over {...} and ;
+# comments so a "[" line inside a comment is not taken for a tag. Every
+# alternative starts on a different byte, so a failed match backtracks linearly.
+_TO_TAG     = re.compile(rb"(?:[^{;\n]|\{[^}]*\}|;[^\n]*|\n(?![ \t]*\[))*\n(?=[ \t]*\[)")
+_FIRST_TAG  = re.compile(rb"\s*\[")
+_NON_WS     = re.compile(rb"\S")
+_BRACE      = re.compile(rb"[{}]")
+_TAG_BLOCK  = re.compile(rb"(?:[ \t]*\[[^\n]*\n|[ \t]*\r?\n)*")
+_SAN_TOKEN  = re.compile(rb"[KQRBN]?[a-h]?[1-8]?x?[a-h][1-8]|[O0]-[O0](?:-[O0])?")
+_TAG        = re.compile(rb'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+_MOVETEXT   = re.compile(r"\{[^}]*\}|;[^\n]*|\$\d+|[()]|[^\s(){};$]+")
+_MOVE_NUM   = re.compile(r"^\d+(?:\.+|$)")
+_RESULTS    = {"1-0", "0-1", "1/2-1/2", "*"}
+_BOM        = b"\xef\xbb\xbf"
+# what chess.pgn.read_game reports for a missing Seven Tag Roster tag
+_ROSTER_DEFAULTS = {"Event": "?", "Site": "?", "Date": "????.??.??",
+                    "Round": "?", "White": "?", "Black": "?", "Result": "*"}
+
+
+def _record_starts(mm, pos, seen_moves):
+    """Yield the offsets of lines that open a new game.
+
+    A tag line opens a game when movetext (anything non-blank, comments
+    included) appears between it and the previous tag line; `pos` must lie
+    outside any comment or tag line, and `seen_moves` says whether movetext
+    precedes it.
+    """
+    last = pos
+    while True:
+        m = _TO_TAG.match(mm, pos)
+        if m is None:
+            return
+        line = m.end()
+        if seen_moves or _NON_WS.search(mm, last, line):
+            yield line
+        seen_moves = False
+        pos = last = mm.find(b"\n", line)
+        if pos < 0:
+            return
+
+
+def _resync(mm, start):
+    """Scan state for a shard beginning at byte `start` mid-file.
+
+    Returns (pos, seen_moves) at the line boundary before `start`, or None
+    when `start` lies on the file's first line.
+    """
+    pos = mm.rfind(b"\n", 0, start)
+    if pos < 0:
+        return None
+
+    # inside a comment if the next brace closes one
+    brace = _BRACE.search(mm, pos)
+    if brace and brace.group() == b"}":
+        return brace.end(), True
+
+    # otherwise: was the last non-blank line a tag line or movetext?
+    end = pos
+    while end > 0:
+        begin = mm.rfind(b"\n", 0, end) + 1
+        text = mm[begin:end].strip()
+        if text:
+            return pos, _TAG.fullmatch(text) is None
+        end = begin - 1
+    return pos, False
+
+
+def _iter_records(mm, start=0, end=None):
+    """Yield raw game records (tags + movetext) from a mapped PGN file.
+
+    Only records whose first byte lies in [start, end) are yielded, so
+    disjoint byte ranges of one file split its games without overlap.
+    """
+    end = len(mm) if end is None else end
+    first = len(_BOM) if mm[:len(_BOM)] == _BOM else 0
+
+    state = _resync(mm, start) if start else None
+    if state is None:
+        pos, seen_moves = first, False
+        tag = _FIRST_TAG.match(mm, first)
+        if tag:  # step over the opening tag line: it starts the first game
+            pos = mm.find(b"\n", tag.end())
+            if pos < 0:
+                pos = len(mm)
+    else:
+        pos, seen_moves = state
+
+    # the record in progress when the scan starts begins before `start`,
+    # unless the scan starts at the top of the file
+    prev = first if state is None else None
+    for bound in chain(_record_starts(mm, pos, seen_moves), [len(mm)]):
+        if prev is not None and start <= prev < end:
+            record = mm[prev:bound]
+            if record.strip():
+                yield record
+        if bound >= end:
+            return
+        prev = bound
+
+
+def _may_have_plies(movetext, min_plies):
+    # Over-counts (comments, variations) but never under-counts, so a game
+    # rejected here could not have passed the exact filter either.
+    count = 0
+    for _ in _SAN_TOKEN.finditer(movetext):
+        count += 1
+        if count >= min_plies:
+            return True
+    return False
 
-    if not Path(pgn_path).is_file():
-        sys.exit(f"PGN not found: {pgn_path}")
 
-    raw = kept = 0
+def _read_tags(tag_block, wanted):
+    """Tags whose (byte) name is in the `wanted` set; others aren't decoded."""
+    tags = {}
+    for m in _TAG.finditer(tag_block):
+        if m.group(1) not in wanted:
+            continue
+        value = m.group(2).decode("utf-8", errors="ignore")
+        tags[m.group(1).decode()] = value.replace('\\"', '"').replace("\\\\", "\\")
+    return tags
+
+
+def _read_moves(movetext, board):
+    """Mainline moves as UCI strings, played on `board` from its current
+    position; variations, comments and NAGs skipped.
+
+    Stops at the result token or at the first unparseable move, keeping
+    whatever was legal up to that point.
+    """
+    moves = []
+    depth = 0
+    for m in _MOVETEXT.finditer(movetext.decode("utf-8", errors="ignore")):
+        tok = m.group()
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            depth = max(0, depth - 1)
+        elif depth or tok[0] in "{;$":
+            continue
+        elif tok in _RESULTS:
+            break
+        else:
+            san = _MOVE_NUM.sub("", tok).rstrip("!?")
+            if not san:
+                continue
+            try:
+                mv = board.parse_san(san)
+            except ValueError:
+                break
+            if not mv:  # null move: nothing the engine could replay
+                break
+            moves.append(mv.uci())
+            board.push(mv)
+    return moves
+
+
+def _parse_shard(pgn_path, start, end, headers_to_keep, max_games,
+                 min_white_moves):
+    """Parse the games starting in [start, end); indices are shard-local.
+
+    Returns (games read, kept games, indices of games with an invalid FEN).
+    """
+    raw = 0
     games = []
+    bad_fen = []
+    min_plies = 2 * min_white_moves - 1
+    wanted = frozenset(h.encode() for h in headers_to_keep) | {b"FEN"}
+
+    with open(pgn_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:  # mmap refuses empty files
+            return raw, games, bad_fen
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    with open(pgn_path, encoding="utf-8", errors="ignore") as f:
-        idx = 1
-        while max_games is None or idx <= max_games:
-            game = chess.pgn.read_game(f)
-            if game is None:
+    with mm:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):  # not on Windows
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        for idx, record in enumerate(_iter_records(mm, start, end), 1):
+            if max_games is not None and idx > max_games:
                 break
 
             raw += 1
-            board = game.board()
-            fens = [board.fen()]
-            white_moves = 0
-            for ply, mv in enumerate(game.mainline_moves()):
-                board.push(mv)
-                fens.append(board.fen())
-                if ply % 2 == 0:
-                    white_moves += 1
+            split = _TAG_BLOCK.match(record).end()
+            movetext = record[split:]
+            if min_plies > 0 and not _may_have_plies(movetext, min_plies):
+                continue
+
+            tags = _read_tags(record[:split], wanted)
+            fen = tags.get("FEN")
+            try:
+                board = chess.Board(fen) if fen else chess.Board()
+            except ValueError:
+                bad_fen.append(idx)
+                continue
+            # python-chess fills in fields a short FEN omits; hand the engine
+            # that normalised position, not the raw tag
+            fen = board.fen() if fen else None
+
+            white_first = board.turn == chess.WHITE
+            moves = _read_moves(movetext, board)
+            white_moves = (len(moves) + white_first) // 2
 
             if white_moves >= min_white_moves:
-                headers = {k: v for k, v in game.headers.items()
-                           if k in headers_to_keep}
-                games.append((idx, headers, fens))
-                kept += 1
-            idx += 1
+                headers = {k: tags.get(k, _ROSTER_DEFAULTS.get(k))
+                           for k in headers_to_keep
+                           if k in tags or k in _ROSTER_DEFAULTS}
+                games.append((idx, headers, fen, moves))
+
+    return raw, games, bad_fen
+
+
+def parse_pgn(pgn_path, headers_to_keep, max_games=None, min_white_moves=0,
+              workers=1):
+
+    if not Path(pgn_path).is_file():
+        sys.exit(f"PGN not found: {pgn_path}")
+
+    # MAX_GAMES needs a global game count, so capped runs parse sequentially;
+    # small files are not worth a process pool either.
+    size = os.path.getsize(pgn_path)
+    n = 1 if max_games is not None else max(1, min(workers, size // _MIN_SHARD))
+    cuts = [size * i // n for i in range(n + 1)]
+    parse = partial(_parse_shard, pgn_path,
+                    headers_to_keep=headers_to_keep, max_games=max_games,
+                    min_white_moves=min_white_moves)
+
+    if n == 1:
+        shards = [parse(0, None)]
+    else:
+        with ProcessPoolExecutor(max_workers=n) as pool:
+            shards = list(pool.map(parse, cuts[:-1], cuts[1:]))
+
+    raw = 0
+    games = []
+    bad_fen = []
+    for shard_start, (shard_raw, shard_games, shard_bad) in zip(cuts, shards):
+        log.debug("shard @%d: %d games read, %d kept",
+                  shard_start, shard_raw, len(shard_games))
+        games.extend((raw + idx, headers, fen, moves)
+                     for idx, headers, fen, moves in shard_games)
+        bad_fen.extend(raw + idx for idx in shard_bad)
+        raw += shard_raw
+    kept = len(games)
 
     print(f"📂 Raw games read: {raw}")
+    if bad_fen:
+        shown = ", ".join(f"#{idx}" for idx in bad_fen[:10])
+        more = ", …" if len(bad_fen) > 10 else ""
+        print(f"⚠️ Skipped {len(bad_fen)} game(s) with an invalid FEN tag: "
+              f"{shown}{more}")
     print(f"✅ Games kept after filter (≥{min_white_moves} white moves): {kept}")
     if not games:
         sys.exit("No games matched the criteria.")
@@ -48,44 +274,186 @@ def parse_pgn(pgn_path, headers_to_keep, max_games=None, min_white_moves=0):
 
 
 
-# 2) Per-chunk Stockfish evaluation
+# 2) Minimal UCI driver: one Stockfish process, raw pipe I/O
 
-def analyse_chunk(chunk, wid, stockfish_path, depth, hash_mb, progress_every):
+def open_engine(stockfish_path, hash_mb):
+    proc = subprocess.Popen(
+        [str(stockfish_path)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+    _send(proc, b"uci")
+    _wait_for(proc, b"uciok")
+    _send(proc, b"setoption name Threads value 1\n"
+                b"setoption name Hash value %d\n"
+                b"isready" % hash_mb)
+    _wait_for(proc, b"readyok")
+    return proc
 
-    engine = chess.engine.SimpleEngine.popen_uci(str(stockfish_path))
-    engine.configure({"Threads": 1, "Hash": hash_mb})
-    limit = chess.engine.Limit(depth=depth)
-
-    results = []
-    total = len(chunk)
-    print(f"[Worker {wid}] starting with {total} games", flush=True)
 
+def close_engine(proc, timeout=5):
+    # bounded: a wedged engine must not keep its worker (and the pool) alive
+    try:
+        _send(proc, b"quit")
+    except OSError:  # already gone
+        pass
     try:
-        for gnum, (idx, headers, fens) in enumerate(chunk, 1):
-            scores = []
-            for fen in fens:
-                info = engine.analyse(chess.Board(fen), limit)
-                sc = info["score"].white()
-                scores.append(
-                    1000 if sc.is_mate() and sc.mate() > 0 else
-                    -1000 if sc.is_mate() else
-                    sc.score()
-                )
-            results.append((idx, headers, scores))
-
-            if gnum % progress_every == 0 or gnum == total:
-                print(f"[Worker {wid}] {gnum}/{total} games analysed", flush=True)
-    finally:
-        engine.quit()
-    return results
-
-
-
-# 3) Utility: split a list into roughly equal chunks
-
-def chunked(lst, n_chunks):
-    if n_chunks <= 0:
-        raise ValueError("n_chunks must be > 0")
-    size = math.ceil(len(lst) / n_chunks)
-    return [lst[i*size : min(len(lst), (i+1)*size)]
-            for i in range(n_chunks) if i*size < len(lst)]
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    for pipe in (proc.stdin, proc.stdout):
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def _send(proc, cmd):
+    proc.stdin.write(cmd + b"\n")
+    proc.stdin.flush()
+
+
+def _wait_for(proc, token):
+    for line in proc.stdout:
+        if line.startswith(token):
+            return
+    raise RuntimeError(f"Stockfish exited before sending {token.decode()}")
+
+
+def evaluate(proc, position, depth, white_to_move):
+    """Search `position` (a full UCI "position ..." command) and return the
+    final score in White's point of view, mates clamped to ±1000."""
+    _send(proc, position + b"\ngo depth %d" % depth)
+
+    # only the last score line matters; skip PV/currmove parsing entirely
+    last = None
+    for line in proc.stdout:
+        if line.startswith(b"bestmove"):
+            break
+        if b" score " in line:
+            last = line
+    else:
+        raise RuntimeError("Stockfish exited mid-search")
+    if last is None:
+        raise RuntimeError("Stockfish reported no score")
+
+    _, _, rest = last.partition(b" score ")
+    kind, value = rest.split(None, 2)[:2]
+    value = int(value)
+    if kind == b"mate":
+        # "mate 0" means the side to move is already mated
+        value = 1000 if value > 0 else -1000
+    return value if white_to_move else -value
+
+
+
+# 3) Move lists shared with workers through one shared-memory block
+
+def share_moves(games):
+    """Pack every game's moves into a single SharedMemory block.
+
+    Returns the block (caller must close + unlink it) and light payloads
+    (idx, headers, fen, start, end) that index into it; fen is None for
+    games from the standard initial position.
+    """
+    packed = bytearray()
+    payloads = []
+    for idx, headers, fen, moves in games:
+        start = len(packed)
+        packed += " ".join(moves).encode()
+        payloads.append((idx, headers, fen, start, len(packed)))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(packed)))
+    shm.buf[:len(packed)] = packed
+    return shm, payloads
+
+
+
+# 4) Worker set-up and per-game Stockfish evaluation
+
+# per-process state, filled once by init_worker for the lifetime of the pool
+_MOVES  = None  # attached shared-memory block from share_moves
+_ENGINE = None  # this worker's Stockfish, reused across all its games
+_DEPTH  = None
+
+_THREAD_CAPS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS",
+                "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def capped_hash_mb(hash_mb, depth):
+    """Shrink Hash to what a fixed-depth search can use: 2**(depth-6) MB,
+    at least 16 MB (64 MB at depth 12, 4 GB at depth 18). A bigger table is
+    only zeroed at start-up and in every ucinewgame, and is less cache-friendly.
+    """
+    return min(hash_mb, 2 ** max(4, depth - 6))
+
+
+def init_worker(shm_name, stockfish_path, depth, hash_mb):
+    global _MOVES, _ENGINE, _DEPTH
+    # one busy Stockfish per worker already fills its core; keep any numeric
+    # library imported later (and child processes) from adding thread pools
+    for var in _THREAD_CAPS:
+        os.environ.setdefault(var, "1")
+    _MOVES = shared_memory.SharedMemory(name=shm_name)
+    _DEPTH = depth
+    _ENGINE = open_engine(stockfish_path, capped_hash_mb(hash_mb, depth))
+    # pool workers skip atexit; multiprocessing finalizers still run
+    Finalize(None, close_engine, args=(_ENGINE,), exitpriority=10)
+
+
+_PIECE_VALUES = ((chess.PAWN, 1), (chess.KNIGHT, 3), (chess.BISHOP, 3),
+                 (chess.ROOK, 5), (chess.QUEEN, 9))
+_DECISIVE_MATERIAL = 20  # pawns; beyond this the result is not in doubt
+
+
+def _trivial_score(board):
+    """White-POV score for positions that need no search, else None."""
+    if board.is_checkmate():
+        return -1000 if board.turn == chess.WHITE else 1000
+    if board.is_stalemate() or board.is_insufficient_material():
+        return 0
+
+    material = 0
+    for piece_type, value in _PIECE_VALUES:
+        material += value * (
+            chess.popcount(board.pieces_mask(piece_type, chess.WHITE))
+            - chess.popcount(board.pieces_mask(piece_type, chess.BLACK))
+        )
+    # 1-ply quiescence guard: with a capture on the board the material count
+    # may be about to change, so leave the position to the engine
+    if abs(material) > _DECISIVE_MATERIAL and not any(
+        board.generate_legal_captures()
+    ):
+        # same saturation value as a mate, so a won ending reads as one
+        return 1000 if material > 0 else -1000
+    return None
+
+
+def analyse_game(payload):
+    idx, headers, fen, start, end = payload
+    engine, depth = _ENGINE, _DEPTH
+    moves = _MOVES.buf[start:end].tobytes().split()
+
+    # Clear the hash once per game only: consecutive plies share most of their
+    # search tree, and the result no longer depends on which games this
+    # worker happened to analyse before. Stockfish handles commands in order,
+    # so no isready round-trip is needed.
+    _send(engine, b"ucinewgame")
+    if fen:
+        board = chess.Board(fen)
+        position = b"position fen " + fen.encode() + b" moves"
+    else:
+        board = chess.Board()
+        position = b"position startpos moves"
+    # int16 per ply; shipped back as raw bytes rather than a list of ints
+    scores = array("h", bytes(2 * (len(moves) + 1)))
+    scores[0] = evaluate(engine, position, depth, board.turn == chess.WHITE)
+    for ply, uci in enumerate(moves, 1):
+        board.push(chess.Move.from_uci(uci.decode()))
+        position += b" " + uci
+        score = _trivial_score(board)
+        if score is None:
+            score = evaluate(engine, position, depth,
+                             board.turn == chess.WHITE)
+        scores[ply] = score
+    return idx, headers, scores.tobytes()